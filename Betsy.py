@@ -15,21 +15,61 @@
 # order of moves in my successor function so that my opponent wouldn't be able to predict what move I would make based on
 # the fact that my successors were always generated in the same order.
 
+import os
 import sys
+import json
+import mmap
+import time
+import struct
+import argparse
 import numpy as np
 import math
 import random
+import multiprocessing
 
-n = int(sys.argv[1])
-startPlayer = sys.argv[2]
-startBoard = list(sys.argv[3])
-time = sys.argv[4]
+parser = argparse.ArgumentParser(description='Recommend a move for the given Betsy board.')
+parser.add_argument('n', type=int, nargs='?')
+parser.add_argument('player', nargs='?')
+parser.add_argument('board', nargs='?')
+parser.add_argument('time', nargs='?')
+parser.add_argument('--engine', action='store_true', help='keep running and read commands from stdin')
+parser.add_argument('--book', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'betsy.book'),
+                    help='opening book and endgame table written by betsy_book.py, used if it exists')
+parser.add_argument('--tt-mb', type=float, default=64, help='memory cap for the transposition table, in megabytes')
+parser.add_argument('--seed', type=int, help='seed for the random choice between equally ordered moves')
+parser.add_argument('--stats', action='store_true', help='print search statistics to stderr as JSON')
+parser.add_argument('--workers', type=int, default=1, help='number of processes searching the root moves')
+parser.add_argument('--search', choices=['alphabeta', 'mcts'], default='alphabeta',
+                    help='alpha-beta search, or Monte Carlo tree search for large boards')
+
+# Settings, filled in from the command line at the bottom of the file.
+tt_mb = 64
+show_stats = False
+workers = 1
+engine_mode = False
+quiet = False
+book_path = None
+start_time = time.time()
+duration = math.inf
 
 
 alpha = -float('inf')
 beta = float('inf')
 recommend = ''
 
+# Iterative deepening gives up at this fraction of the time budget, and checks the clock every
+# CLOCK_INTERVAL + 1 nodes rather than on every node. It never goes deeper than MAX_DEPTH.
+TIME_SAFETY = 0.9
+CLOCK_INTERVAL = 255
+MAX_DEPTH = 64
+deadline = math.inf
+depth_cut = False
+last_depth = 0
+
+
+class SearchTimeout(Exception):
+    pass
+
 
 def drop(player, column, board, n):
     board1 = list(board)
@@ -123,83 +163,994 @@ def win_test(player, board, n):
             return True
 
 
-def max_value(player, board, alpha, beta, n, path):
-    if win_test(player, board, n):
-        if len(path) > 1:
-            global recommend
-            recommend = path[1]
-        return value(player, board, n)
-    if len(path) >n:
-        for move in path:
-            if move in ['rotate1', 'rotate2', 'rotate3'] and path.count(move) >= n:
-                if len(path) > 1:
-                    recommend = path[1]
-                return value(player, board, n)
-    a = -float('inf')
-    successors1 = successors(player, board, n)
+# Bitboard representation. A position is (white, black, heights): one integer mask per player with bit
+# row*n + column set for each of their pebbles (same cell order as the board string), plus a tuple holding
+# how many pebbles are stacked in each column. Masks for a given n are built once and cached in _geometry.
+PLAYERS = 'wb'
+_geometry = {}
+
+
+def geometry(n):
+    if n in _geometry:
+        return _geometry[n]
+    rows = n + 3
+    full_row = (1 << n) - 1
+    columns = []
+    for c in range(0, n):
+        mask = 0
+        for r in range(0, rows):
+            mask |= 1 << (r * n + c)
+        columns.append(mask)
+    wins = []
+    for r in range(0, n):
+        wins.append(full_row << (r * n))
+    for c in range(0, n):
+        mask = 0
+        for r in range(0, n):
+            mask |= 1 << (r * n + c)
+        wins.append(mask)
+    diag = 0
+    anti = 0
+    diag_above = 0
+    anti_above = 0
+    for k in range(0, n):
+        diag |= 1 << (k * n + k)
+        anti |= 1 << (k * n + n - 1 - k)
+        if k > 0:
+            diag_above |= 1 << ((k - 1) * n + k)
+            anti_above |= 1 << ((k - 1) * n + n - 1 - k)
+    wins.append(diag)
+    wins.append(anti)
+    bottom = (rows - 1) * n
+    keys = random.Random(n)
+    zobrist = ([keys.getrandbits(64) for i in range(0, n * rows)], [keys.getrandbits(64) for i in range(0, n * rows)])
+    mirror = ([], [])
+    for p in 0, 1:
+        for i in range(0, n * rows):
+            mirror[p].append(zobrist[p][i - i % n + n - 1 - i % n])
+    g = {
+        'rows': rows,
+        'full_row': full_row,
+        'columns': columns,
+        'wins': wins,
+        'top': (1 << (n * n)) - 1,
+        'bottom': bottom,
+        'scored': ((1 << (n * n)) - 1) | (full_row << bottom),
+        'diag': diag,
+        'anti': anti,
+        'diag_above': diag_above,
+        'anti_above': anti_above,
+        'diag_first': 1 << bottom,
+        'anti_first': 1 << (bottom + n - 1),
+        'zobrist': zobrist,
+        'mirror': mirror,
+        'side': keys.getrandbits(64),
+        'player': (keys.getrandbits(64), keys.getrandbits(64)),
+    }
+    _geometry[n] = g
+    return g
+
+
+def board_to_bits(board, n):
+    masks = [0, 0]
+    heights = []
+    rows = n + 3
+    for c in range(0, n):
+        h = 0
+        while h < rows and board[(rows - 1 - h) * n + c] != '.':
+            h += 1
+        heights.append(h)
+    for i in range(0, n * rows):
+        if board[i] in PLAYERS:
+            masks[PLAYERS.index(board[i])] |= 1 << i
+    return (masks[0], masks[1], tuple(heights))
+
+
+def bits_to_board(pos, n):
+    board = []
+    for i in range(0, n * (n + 3)):
+        bit = 1 << i
+        if pos[0] & bit:
+            board.append(PLAYERS[0])
+        elif pos[1] & bit:
+            board.append(PLAYERS[1])
+        else:
+            board.append('.')
+    return board
+
+
+def bit_drop(p, column, pos, n):
+    heights = pos[2]
+    h = heights[column - 1]
+    if h == n + 3:
+        return None
+    cell = 1 << ((n + 2 - h) * n + column - 1)
+    heights = heights[:column - 1] + (h + 1,) + heights[column:]
+    if p == 0:
+        return (pos[0] | cell, pos[1], heights)
+    return (pos[0], pos[1] | cell, heights)
+
+
+# Moves every pebble in the column down one row and puts the bottom pebble back on top of the stack,
+# which is what rotate() does with its shift followed by the gravity pass.
+def bit_rotate(column, pos, n):
+    h = pos[2][column - 1]
+    if h < 2:
+        return pos
+    c = column - 1
+    colmask = geometry(n)['columns'][c]
+    low = 1 << ((n + 2) * n + c)
+    high = 1 << ((n + 3 - h) * n + c)
+    masks = []
+    for m in pos[0], pos[1]:
+        col = m & colmask
+        moved = (col & ~low) << n
+        if col & low:
+            moved |= high
+        masks.append((m & ~colmask) | moved)
+    return (masks[0], masks[1], pos[2])
+
+
+def bit_win(mask, n):
+    for line in geometry(n)['wins']:
+        if mask & line == line:
+            return True
+    return False
+
+
+def bit_successors(p, pos, n):
+    actions = []
+    for i in range(1, n + 1):
+        a = bit_drop(p, i, pos, n)
+        if a is not None:
+            actions.append(['drop', i, a])
+        actions.append(['rotate', i, bit_rotate(i, pos, n)])
+    return actions
+
+
+# Zobrist hash of a position: the XOR of one fixed random key per (player, cell) pebble. The keys are
+# seeded by n so hashes are the same from run to run.
+#
+# The rules are the same with the columns mirrored left to right, so every position is hashed twice: as
+# it is and as its mirror image (the 'mirror' keys are the same keys with the columns reversed). The
+# smaller of the two is the position's canonical key, shared by a position and its mirror image. Moves
+# stored under a canonical key are stored as they would be played on whichever of the two positions
+# has the smaller plain key, and mirror_move() flips them back when needed.
+def zobrist(pos, n):
+    return zobrist_update(0, 0, (0, 0), pos, n)
+
+
+# Hash and mirrored hash of the root position, with the player to move included. Both players' keys are
+# drawn from the per-n generator, so even the empty board hashes differently for every n, and book or
+# transposition table entries for one board size are never found for another.
+def root_keys(pos, player, n):
+    key, mirror = zobrist(pos, n)
+    turn = geometry(n)['player'][PLAYERS.index(player)]
+    return key ^ turn, mirror ^ turn
+
+
+# Updates both hashes by toggling the keys of every cell that differs between two positions, which is
+# one cell for a drop and at most the column height for a rotate.
+def zobrist_update(key, mirror, old, new, n):
+    g = geometry(n)
+    for p in 0, 1:
+        diff = old[p] ^ new[p]
+        while diff:
+            low = diff & -diff
+            i = low.bit_length() - 1
+            key ^= g['zobrist'][p][i]
+            mirror ^= g['mirror'][p][i]
+            diff ^= low
+    return key, mirror
+
+
+def mirror_move(move, n):
+    if move is None:
+        return None
+    return move[:-1] + str(n + 1 - int(move[-1:]))
+
+
+# Same score as value(): row pairs (including the bottom row paired with the top row), the pebble balance
+# over the top n rows plus the bottom row, and the two diagonal pairs.
+def bit_value(p, pos, n):
+    g = geometry(n)
+    mine = pos[p]
+    full = g['full_row']
+    score = bin(mine & g['scored']).count('1') - bin(pos[1 - p] & g['scored']).count('1')
+    if ((mine | (mine >> g['bottom'])) & full) == full:
+        score += 1
+    for r in range(1, n):
+        if (((mine >> (r * n)) | (mine >> ((r - 1) * n))) & full) == full:
+            score += 1
+    cover = (mine & g['diag']) | ((mine & g['diag_above']) << n)
+    if mine & g['diag_first']:
+        cover |= 1
+    if cover == g['diag']:
+        score += 1
+    cover = (mine & g['anti']) | ((mine & g['anti_above']) << n)
+    if mine & g['anti_first']:
+        cover |= 1 << (n - 1)
+    if cover == g['anti']:
+        score += 1
+    return score
+
+
+# Leaf scores, cached by Zobrist key with one table per player. Most leaves are transpositions of one
+# another (rotating a column with fewer than two pebbles changes nothing, for one), so most bit_value()
+# calls in a search are repeats. A table is emptied once it reaches EVAL_CACHE_SIZE entries.
+EVAL_CACHE_SIZE = 1 << 18
+eval_cache = ({}, {})
+
+
+def leaf_value(p, pos, key, n):
+    global leaves
+    leaves += 1
+    cache = eval_cache[p]
+    score = cache.get(key)
+    if score is None:
+        if len(cache) >= EVAL_CACHE_SIZE:
+            cache.clear()
+        score = cache[key] = bit_value(p, pos, n)
+    return score
+
+
+# Search statistics. The counters are plain integer increments and are always kept. Timing value and
+# win tests means wrapping bit_value() and bit_win(), which instrument() only does when --stats is on, so
+# the search pays nothing for it otherwise. Workers send their counters back with each root move.
+nodes = 0
+leaves = 0
+cutoffs = 0
+first_cutoffs = 0
+ply_cutoffs = []
+tt_hits = 0
+tt_cutoffs = 0
+playouts = 0
+calls = {}
+
+
+def timed(name, function):
+    calls[name] = [0, 0.0]
+    def wrapper(*args):
+        started = time.perf_counter()
+        result = function(*args)
+        entry = calls[name]
+        entry[0] += 1
+        entry[1] += time.perf_counter() - started
+        return result
+    return wrapper
+
+
+def instrument():
+    global bit_value, bit_win
+    if not calls:
+        bit_value = timed('value', bit_value)
+        bit_win = timed('win_test', bit_win)
+
+
+def stats_reset():
+    global nodes, leaves, cutoffs, first_cutoffs, tt_hits, tt_cutoffs, playouts
+    nodes = leaves = cutoffs = first_cutoffs = tt_hits = tt_cutoffs = playouts = 0
+    del ply_cutoffs[:]
+    for entry in calls.values():
+        entry[0] = 0
+        entry[1] = 0.0
+
+
+def stats_snapshot():
+    return {
+        'nodes': nodes,
+        'leaves': leaves,
+        'cutoffs': cutoffs,
+        'first_cutoffs': first_cutoffs,
+        'ply_cutoffs': list(ply_cutoffs),
+        'tt_hits': tt_hits,
+        'tt_cutoffs': tt_cutoffs,
+        'playouts': playouts,
+        'calls': dict((name, list(entry)) for name, entry in calls.items()),
+    }
+
+
+# Adds the counters a worker sent back for one root move. Its plies already count from our root.
+def stats_add(snapshot):
+    global nodes, leaves, cutoffs, first_cutoffs, tt_hits, tt_cutoffs, playouts
+    nodes += snapshot['nodes']
+    leaves += snapshot['leaves']
+    cutoffs += snapshot['cutoffs']
+    first_cutoffs += snapshot['first_cutoffs']
+    tt_hits += snapshot['tt_hits']
+    tt_cutoffs += snapshot['tt_cutoffs']
+    playouts += snapshot['playouts']
+    for ply in range(0, len(snapshot['ply_cutoffs'])):
+        while len(ply_cutoffs) <= ply:
+            ply_cutoffs.append(0)
+        ply_cutoffs[ply] += snapshot['ply_cutoffs'][ply]
+    for name, entry in snapshot['calls'].items():
+        calls[name][0] += entry[0]
+        calls[name][1] += entry[1]
+
+
+def stats_report(player, n, score, started, book_hit):
+    elapsed = time.time() - started
+    report = {
+        'n': n,
+        'player': player,
+        'move': recommend,
+        'score': score,
+        'book': book_hit,
+        'depth': last_depth,
+        'seconds': round(elapsed, 4),
+        'nodes': nodes,
+        'leaves': leaves,
+        'nodes_per_second': int((nodes + leaves) / elapsed) if elapsed > 0 else 0,
+        'cutoffs': cutoffs,
+        'first_move_cutoff_rate': round(float(first_cutoffs) / cutoffs, 4) if cutoffs else 0.0,
+        'cutoffs_per_ply': ply_cutoffs,
+        'tt_hits': tt_hits,
+        'tt_cutoffs': tt_cutoffs,
+        'playouts': playouts,
+        'playouts_per_second': int(playouts / elapsed) if elapsed > 0 else 0,
+    }
+    for name, entry in calls.items():
+        report[name] = {'calls': entry[0], 'seconds': round(entry[1], 4)}
+    sys.stderr.write(json.dumps(report) + '\n')
+
+
+# Transposition table. A fixed number of slots (a power of two sized from the memory cap) indexed by the
+# low bits of the Zobrist key, each holding (key, depth, score, bound, best move, generation). A slot is
+# overwritten by the same position, by anything from an older search, or by a search at least as deep.
+EXACT = 0
+LOWER = 1
+UPPER = 2
+TT_ENTRY_BYTES = 160
+tt = []
+tt_mask = 0
+tt_generation = 0
+
+
+def tt_resize(mb):
+    global tt, tt_mask
+    slots = 1
+    while slots * 2 * TT_ENTRY_BYTES <= mb * 1024 * 1024:
+        slots *= 2
+    tt = [None] * slots
+    tt_mask = slots - 1
+
+
+def tt_probe(key):
+    entry = tt[key & tt_mask]
+    if entry is not None and entry[0] == key:
+        return entry
+    return None
+
+
+def tt_store(key, depth, score, bound, move):
+    i = key & tt_mask
+    entry = tt[i]
+    if entry is None or entry[0] == key or entry[5] != tt_generation or depth >= entry[1]:
+        tt[i] = (key, depth, score, bound, move, tt_generation)
+
+
+# The transposition table keeps win and loss scores counted from the node that stored them rather than
+# from the root of that search, so they read back right at another ply or in a later search.
+def score_to_tt(score, ply):
+    if score >= WIN - MAX_DEPTH:
+        return score + ply
+    if score <= -(WIN - MAX_DEPTH):
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score >= WIN - MAX_DEPTH:
+        return score - ply
+    if score <= -(WIN - MAX_DEPTH):
+        return score + ply
+    return score
+
+
+# Move ordering. Moves that complete a line come first, then the transposition table move, then the two
+# killer moves stored for this ply, then the rest by history score. history is keyed by move name
+# ('drop2', 'rotate1', ...) and gains depth * depth every time that move causes a cutoff. The caller
+# shuffles the moves beforehand and the sort is stable, so moves that tie stay in random order.
+killers = []
+history = {}
+
+
+def order_moves(p, successors1, ply, best, n):
+    while len(killers) <= ply:
+        killers.append([None, None])
+    killer = killers[ply]
+    for successor in successors1:
+        name = successor[0] + str(successor[1])
+        if bit_win(successor[2][p], n):
+            rank = 4
+        elif name == best:
+            rank = 3
+        elif name == killer[0]:
+            rank = 2
+        elif name == killer[1]:
+            rank = 1
+        else:
+            rank = 0
+        successor.append(name)
+        successor.append((rank, history.get(name, 0)))
+    successors1.sort(key=lambda successor: successor[4], reverse=True)
+
+
+def record_cutoff(ply, move, depth, first):
+    global cutoffs, first_cutoffs
+    cutoffs += 1
+    if first:
+        first_cutoffs += 1
+    while len(ply_cutoffs) <= ply:
+        ply_cutoffs.append(0)
+    ply_cutoffs[ply] += 1
+    history[move] = history.get(move, 0) + depth * depth
+    killer = killers[ply]
+    if killer[0] != move:
+        killer[1] = killer[0]
+        killer[0] = move
+
+
+# Repetition detection. Every position on the current search path is counted in repetitions as it is
+# expanded, keyed by its Zobrist key (which includes the side to move), and uncounted on the way back
+# up. A node whose key is already counted has been reached before on this path, usually through
+# rotations that cycle a column back round, and is scored as a leaf instead of searched again. A search
+# abandoned by a timeout leaves the counts dirty, so every search starts from clear_path().
+repetitions = {}
+
+
+def clear_path(*start):
+    repetitions.clear()
+    for key in start:
+        repetitions[key] = repetitions.get(key, 0) + 1
+
+
+# Negamax search with principal variation search. Scores are from the point of view of the player to
+# move (side), so a child's score is negated on the way up. Leaves are scored with the heuristic for the
+# player we are recommending a move for (root_player) and negated on the other player's turns, which
+# is the max/min the search always did. A position where the player who just moved has completed a line
+# is a loss for the side to move, and one where only the side to move has a line is a win; both are
+# worth WIN less the ply, so quicker wins score higher (the root itself is always searched). After the
+# first move every move is searched with a null window, and searched again with the full window only if
+# it beats alpha. Returns the score and the best move found, which is None at a leaf.
+WIN = 100000
+root_player = 0
+
+
+def evaluate(side, pos, canonical, n):
+    score = leaf_value(root_player, pos, canonical, n)
+    if side == root_player:
+        return score
+    return -score
+
+
+def negamax(side, pos, key, mirror, alpha, beta, depth, ply, n):
+    global depth_cut, nodes, tt_hits, tt_cutoffs
+    canonical = min(key, mirror)
+    if ply > 0 and bit_win(pos[1 - side], n):
+        return -(WIN - ply), None
+    if ply > 0 and bit_win(pos[side], n):
+        return WIN - ply, None
+    if key in repetitions:
+        return evaluate(side, pos, canonical, n), None
+    if depth <= 0:
+        depth_cut = True
+        return evaluate(side, pos, canonical, n), None
+    nodes += 1
+    if nodes & CLOCK_INTERVAL == 0 and time.time() > deadline:
+        raise SearchTimeout()
+    entry = tt_probe(canonical)
+    best = None
+    if entry is not None:
+        tt_hits += 1
+        best = entry[4] if key == canonical else mirror_move(entry[4], n)
+        if entry[1] >= depth and ply > 0:
+            score = score_from_tt(entry[2], ply)
+            if entry[3] == EXACT or (entry[3] == LOWER and score >= beta) or (entry[3] == UPPER and score <= alpha):
+                tt_cutoffs += 1
+                depth_cut = True
+                return score, best
+    alpha0 = alpha
+    successors1 = bit_successors(side, pos, n)
     random.shuffle(successors1)
+    order_moves(side, successors1, ply, best, n)
+    flip = geometry(n)['side']
+    seen = set()
+    a = -float('inf')
+    best = None
+    repetitions[key] = repetitions.get(key, 0) + 1
     for successor in successors1:
-        path1 = list(path)
-        path1.append(successor[0]+str(successor[1]))
-        a = max(a, min_value(player, successor[2], alpha, beta, n, path1))
+        child, child_mirror = zobrist_update(key ^ flip, mirror ^ flip, pos, successor[2], n)
+        if ply == 0:
+            if min(child, child_mirror) in seen:
+                continue
+            seen.add(min(child, child_mirror))
+        if best is None:
+            b = -negamax(1 - side, successor[2], child, child_mirror, -beta, -alpha, depth - 1, ply + 1, n)[0]
+        else:
+            b = -negamax(1 - side, successor[2], child, child_mirror, -alpha - 1, -alpha, depth - 1, ply + 1, n)[0]
+            if alpha < b < beta:
+                b = -negamax(1 - side, successor[2], child, child_mirror, -beta, -alpha, depth - 1, ply + 1, n)[0]
+        if best is None or b > a:
+            a = b
+            best = successor[3]
+        if a > alpha:
+            alpha = a
         if a >= beta:
-            if len(path) > 1:
-                recommend = path[1]
-                answer(player, startBoard, n)
-            return a
-        alpha = max(alpha, a)
-    if len(path) > 1:
-        recommend = path[1]
-    return a
-
-def min_value(player, board, alpha, beta, n, path):
-    global recommend
-    if win_test(player, board, n):
-        if len(path) > 1:
-            recommend = path[1]
-        return value(player, board, n)
-    if len(path) > n:
-        for move in path:
-            if move in ['rotate1', 'rotate2', 'rotate3'] and path.count(move)>= n:
-                if len(path) > 1:
-                    recommend = path[1]
-                return value(player, board, n)
-    a = float('inf')
-    successors1 = successors(player, board, n)
+            record_cutoff(ply, best, depth, successor is successors1[0])
+            break
+    if repetitions[key] == 1:
+        del repetitions[key]
+    else:
+        repetitions[key] -= 1
+    if a >= beta:
+        bound = LOWER
+    elif a <= alpha0:
+        bound = UPPER
+    else:
+        bound = EXACT
+    tt_store(canonical, depth, score_to_tt(a, ply), bound, best if key == canonical else mirror_move(best, n))
+    return a, best
+
+
+# Parallel root search. The root moves of each depth are handed out to a pool of worker processes, each
+# with its own transposition table, history and killers. The best root score found so far is kept in a
+# shared value that every worker reads as its alpha before starting on a move, so later moves are
+# searched with the tightest bound available. Moves come back in root order and the first strictly best
+# score wins, as in the serial search.
+shared_alpha = None
+pool = None
+
+
+def init_worker(alpha_value, mb):
+    global shared_alpha
+    shared_alpha = alpha_value
+    tt_resize(mb)
+
+
+def search_root_move(task):
+    global deadline, depth_cut, tt_generation, root_player
+    p, pos, key, mirror, root, name, upper, depth, n, deadline, generation = task
+    if generation != tt_generation:
+        tt_generation = generation
+        del killers[:]
+    root_player = p
+    depth_cut = False
+    stats_reset()
+    clear_path(root)
+    try:
+        b = -negamax(1 - p, pos, key, mirror, -upper, -shared_alpha.value, depth - 1, 1, n)[0]
+    except SearchTimeout:
+        b = None
+    else:
+        with shared_alpha.get_lock():
+            if b > shared_alpha.value:
+                shared_alpha.value = b
+    return (name, b, depth_cut, stats_snapshot())
+
+
+def parallel_root(pool, p, pos, key, mirror, lower, upper, depth, n, best):
+    global depth_cut
+    shared_alpha.value = lower
+    successors1 = bit_successors(p, pos, n)
     random.shuffle(successors1)
+    order_moves(p, successors1, 0, best, n)
+    side = geometry(n)['side']
+    seen = set()
+    tasks = []
     for successor in successors1:
-        path1 = list(path)
-        path1.append(successor[0] + str(successor[1]))
-        a = min(a, max_value(player, successor[2], alpha, beta, n, path1))
-        if a <= alpha:
-            if len(path) > 1:
-                recommend = path[1]
-            return a
-        beta = min(beta, a)
-    if len(path) > 1:
-        recommend = path[1]
-    return a
+        child, child_mirror = zobrist_update(key ^ side, mirror ^ side, pos, successor[2], n)
+        if min(child, child_mirror) in seen:
+            continue
+        seen.add(min(child, child_mirror))
+        tasks.append((p, successor[2], child, child_mirror, key, successor[3], upper, depth, n, deadline,
+                      tt_generation))
+    a = -float('inf')
+    move = None
+    finished = True
+    for result in pool.imap(search_root_move, tasks):
+        stats_add(result[3])
+        if result[1] is None:
+            finished = False
+            continue
+        depth_cut = depth_cut or result[2]
+        if result[1] > a:
+            a = result[1]
+            move = result[0]
+    if not finished:
+        raise SearchTimeout()
+    return a, move
+
+
+# Opening book and endgame table. The file (written by betsy_book.py) is a 16 byte header holding the
+# magic string and the record count, followed by fixed size records sorted by key and then n:
+#     key (the root's canonical Zobrist key, player to move included), score, move kind, column, depth, n
+# A record only answers for the board size it was searched on.
+# The move is stored for the orientation with the smaller plain key, like transposition table moves.
+# The file is memory mapped and binary searched, so a probe reads O(log n) records and the file is
+# never loaded as a whole.
+BOOK_MAGIC = b'BETSYBK3'
+BOOK_HEADER = struct.Struct('<8sQ')
+BOOK_RECORD = struct.Struct('<QiBBBB')
+BOOK_MOVES = ['drop', 'rotate']
+book = None
+
+
+def book_open(path):
+    global book
+    if book is None or book[0] != path:
+        book = (path, None, 0)
+        if path is not None and os.path.exists(path) and os.path.getsize(path) >= BOOK_HEADER.size:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, count = BOOK_HEADER.unpack_from(data, 0)
+            if magic == BOOK_MAGIC:
+                book = (path, data, count)
+    return book
+
+
+def book_probe(key, n):
+    path, data, count = book_open(book_path)
+    low = 0
+    high = count
+    while low < high:
+        mid = (low + high) // 2
+        record = BOOK_RECORD.unpack_from(data, BOOK_HEADER.size + mid * BOOK_RECORD.size)
+        if (record[0], record[5]) < (key, n):
+            low = mid + 1
+        else:
+            high = mid
+    if low < count:
+        record = BOOK_RECORD.unpack_from(data, BOOK_HEADER.size + low * BOOK_RECORD.size)
+        if record[0] == key and record[5] == n:
+            return record
+    return None
+
+
+# Monte Carlo tree search (UCT), for boards too wide for the alpha-beta search to get deep enough. Each
+# playout walks down the tree taking the child with the best UCT score (unvisited children first, in a
+# random order), adds the first position that is not in the tree yet, finishes the game from there with
+# random moves and credits every position on the way down with 1 for a win, 0 for a loss and 0.5 for a
+# draw. Rotations can go on forever, so a random game that runs MCTS_PLAYOUT_PLIES times the number of
+# cells without a line is a draw, and so is walking back into a position already on the way down.
+#
+# The tree is a dict from Zobrist key (player to move included) to [visits, reward, children], where the
+# reward is counted for the player who moved into the position and children is filled in the first time
+# the position is walked through. Being keyed by position it is shared between transpositions, and in
+# engine mode it is kept from one move to the next: each search starts by dropping every position that
+# can no longer be reached from its root. It stops growing at MCTS_NODES positions.
+MCTS_EXPLORE = 1.4
+MCTS_PLAYOUT_PLIES = 2
+MCTS_NODES = 1 << 20
+search_mode = 'alphabeta'
+mcts_tree = {}
+
+
+def winner(side, pos, n):
+    if bit_win(pos[1 - side], n):
+        return 1 - side
+    if bit_win(pos[side], n):
+        return side
+    return None
+
+
+# A drop can only complete a line for the player dropping, so only rotations need both players tested.
+def random_game(side, pos, n):
+    won = winner(side, pos, n)
+    moves = 2 * n
+    for ply in range(0, MCTS_PLAYOUT_PLIES * n * (n + 3)):
+        if won is not None:
+            return won
+        move = int(random.random() * moves)
+        if move < n:
+            pos = bit_rotate(move + 1, pos, n)
+            won = winner(1 - side, pos, n)
+        else:
+            child = bit_drop(side, move - n + 1, pos, n)
+            if child is None:
+                continue
+            pos = child
+            if bit_win(pos[side], n):
+                won = side
+        side = 1 - side
+    return won
+
+
+def mcts_playout(side, pos, key, n):
+    global playouts, last_depth
+    flip = geometry(n)['side']
+    path = []
+    seen = set()
+    won = None
+    while True:
+        node = mcts_tree.get(key)
+        if node is None:
+            if len(mcts_tree) < MCTS_NODES:
+                node = mcts_tree[key] = [0, 0.0, None]
+                path.append((node, 1 - side))
+            won = random_game(side, pos, n)
+            break
+        if key in seen:
+            break
+        seen.add(key)
+        path.append((node, 1 - side))
+        if len(path) > 1:
+            won = winner(side, pos, n)
+            if won is not None:
+                break
+        if node[2] is None:
+            node[2] = []
+            for successor in bit_successors(side, pos, n):
+                child = zobrist_update(key ^ flip, 0, pos, successor[2], n)[0]
+                node[2].append((successor[0] + str(successor[1]), successor[2], child))
+            random.shuffle(node[2])
+        explore = MCTS_EXPLORE * math.sqrt(math.log(node[0] + 1))
+        best = None
+        for child in node[2]:
+            stats = mcts_tree.get(child[2])
+            if stats is None or stats[0] == 0:
+                best = child
+                break
+            uct = stats[1] / stats[0] + explore / math.sqrt(stats[0])
+            if best is None or uct > best_uct:
+                best = child
+                best_uct = uct
+        side = 1 - side
+        pos = best[1]
+        key = best[2]
+    for node, mover in path:
+        node[0] += 1
+        if won == mover:
+            node[1] += 1
+        elif won is None:
+            node[1] += 0.5
+    playouts += 1
+    last_depth = max(last_depth, len(path) - 1)
+
+
+def mcts_prune(root):
+    global mcts_tree
+    kept = {}
+    stack = [root]
+    while stack:
+        key = stack.pop()
+        node = mcts_tree.get(key)
+        if node is not None and key not in kept:
+            kept[key] = node
+            if node[2] is not None:
+                for child in node[2]:
+                    stack.append(child[2])
+    mcts_tree = kept
+
+
+# The root move played most often, with its win rate.
+def mcts_best(key):
+    best = None
+    for child in mcts_tree[key][2] or []:
+        stats = mcts_tree.get(child[2])
+        if stats is not None and (best is None or stats[0] > best[1]):
+            best = (child[0], stats[0], stats[1] / stats[0])
+    return best
+
+
+# Runs playouts until the deadline, printing the most played root move whenever it changes (checked
+# every MCTS_REPORT playouts) and once more at the end. Returns the win rate of the move played.
+MCTS_REPORT = 64
+
+def mcts_search(side, pos, key, player, board, n):
+    global recommend, last_depth
+    mcts_prune(key)
+    if key not in mcts_tree:
+        mcts_tree[key] = [0, 0.0, None]
+    last_depth = 0
+    best = None
+    while True:
+        mcts_playout(side, pos, key, n)
+        done = time.time() > deadline
+        if done or playouts % MCTS_REPORT == 0:
+            move = mcts_best(key)
+            if move is not None and (best is None or move[0] != best[0]):
+                recommend = move[0]
+                if not quiet:
+                    answer(player, board, n)
+            best = move
+        if done:
+            break
+    return round(best[2], 4)
+
+
+# Iterative deepening: searches depth 1, 2, 3, ... and prints the root move of each completed depth, so
+# the last line printed is always the deepest finished answer. Positions in the book are answered
+# straight from it. A depth that runs past the deadline is thrown away, and the search stops early once
+# a depth finishes without reaching its depth limit (a transposition table cutoff counts as reaching it,
+# since the stored entry may have been cut short). From the second depth on the root is searched with
+# an aspiration window of ASPIRATION either side of the previous score, widened to the full window on
+# the side it fails.
+ASPIRATION = 2
 
 def betsy_solver(player, board, n):
     global recommend
-    c = max_value(player, board, alpha, beta, n, ['start'])
-    answer(player, board, n)
+    global tt_generation
+    global deadline
+    global depth_cut
+    global shared_alpha, pool
+    global last_depth, root_player
+    if not tt:
+        tt_resize(tt_mb)
+    tt_generation += 1
+    started = time.time()
+    stats_reset()
+    del killers[:]
+    for move in history:
+        history[move] //= 2
+    deadline = start_time + duration * TIME_SAFETY
+    pos = board_to_bits(board, n)
+    root_player = PLAYERS.index(player)
+    key, mirror = root_keys(pos, player, n)
+    record = book_probe(min(key, mirror), n)
+    if record is not None:
+        move = BOOK_MOVES[record[2]] + str(record[3])
+        if mirror < key:
+            move = mirror_move(move, n)
+        if move[:-1] == 'rotate' or bit_drop(0, int(move[-1:]), pos, n) is not None:
+            recommend = move
+            last_depth = record[4]
+            if not quiet:
+                answer(player, board, n)
+            if show_stats:
+                stats_report(player, n, record[1], started, True)
+            return record[1]
+    if search_mode == 'mcts':
+        score = mcts_search(root_player, pos, key, player, board, n)
+        if show_stats:
+            stats_report(player, n, score, started, False)
+        return score
+    if workers > 1 and pool is None:
+        shared_alpha = multiprocessing.Value('d', alpha)
+        pool = multiprocessing.Pool(workers, init_worker, (shared_alpha, tt_mb))
+    done = ''
+    score = None
+    completed = 0
+    depth = 1
+    while True:
+        depth_cut = False
+        lower = alpha
+        upper = beta
+        if score is not None and abs(score) < WIN - MAX_DEPTH:
+            lower = score - ASPIRATION
+            upper = score + ASPIRATION
+        try:
+            while True:
+                if pool is None:
+                    clear_path()
+                    c, move = negamax(root_player, pos, key, mirror, lower, upper, depth, 0, n)
+                else:
+                    c, move = parallel_root(pool, root_player, pos, key, mirror, lower, upper, depth, n, done)
+                if c <= lower and lower > alpha:
+                    lower = alpha
+                elif c >= upper and upper < beta:
+                    upper = beta
+                else:
+                    break
+        except SearchTimeout:
+            break
+        done = move
+        recommend = move
+        score = c
+        completed = depth
+        if not quiet:
+            answer(player, board, n)
+        if not depth_cut or depth == MAX_DEPTH or time.time() > deadline:
+            break
+        depth += 1
+    if pool is not None and not engine_mode:
+        pool.terminate()
+        pool = None
+    recommend = done
+    last_depth = completed
+    if show_stats:
+        stats_report(player, n, score, started, False)
+    return score
+
+
+# Persistent engine mode. Reads one command per line from stdin:
+#     position <n> <player> <board>
+#     go <seconds>
+#     quit
+# and answers each go with a line such as 'drop 3 <board>' or 'rotate 1 <board>'. The transposition
+# table, history, leaf scores, worker pool and Monte Carlo tree stay alive between moves. A line that
+# cannot be used (an unknown command, a position whose board does not fit n, a time that is not a
+# number) is answered with 'error ...' and otherwise ignored, so it cannot take that state down with it.
+def parse_position(words):
+    if not words[1].isdigit() or int(words[1]) < 1 or words[2] not in PLAYERS:
+        return None
+    n = int(words[1])
+    if len(words[3]) != n * (n + 3) or set(words[3]) - set('.' + PLAYERS):
+        return None
+    return n, words[2], list(words[3])
+
+
+def parse_seconds(word):
+    try:
+        seconds = float(word)
+    except ValueError:
+        return None
+    if not seconds > 0:
+        return None
+    return seconds
+
+
+def engine_loop():
+    global start_time, duration
+    n = player = board = None
+    for line in sys.stdin:
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'quit':
+            break
+        elif words[0] == 'position' and len(words) == 4:
+            position = parse_position(words)
+            if position is None:
+                print('error bad position', line.strip())
+            else:
+                n, player, board = position
+        elif words[0] == 'go' and len(words) == 2:
+            if board is None:
+                print('error no position')
+            elif parse_seconds(words[1]) is None:
+                print('error bad time', line.strip())
+            else:
+                start_time = time.time()
+                duration = parse_seconds(words[1])
+                betsy_solver(player, board, n)
+                print(recommend[:-1], recommend[-1:], "".join(move_board(player, board, n, recommend)))
+        else:
+            print('error unknown command', line.strip())
+        sys.stdout.flush()
+    if pool is not None:
+        pool.terminate()
 
 
 def pretty_board(board, n):
     for i in range(0, len(board)-1, n):
         print(board[i:i+n])
 
+def move_board(player, board, n, move):
+    pos = board_to_bits(board, n)
+    if move[:-1] == 'drop':
+        return bits_to_board(bit_drop(PLAYERS.index(player), int(move[-1:]), pos, n), n)
+    return bits_to_board(bit_rotate(int(move[-1:]), pos, n), n)
+
 def answer(player, board, n):
+    ansBoard = "".join(move_board(player, board, n, recommend))
     if recommend[:-1] == 'drop':
-        ansBoard = "".join(drop(player, int(recommend[-1:]), board, n))
         print("I'd recommend dropping a pebble in column ",recommend[-1:],". ",ansBoard)
     else:
-        ansBoard = "".join(rotate(int(recommend[-1:]), board, n))
         print("I'd recommend rotating column ",recommend[-1:],". ",ansBoard)
 
 
-betsy_solver(startPlayer, startBoard, n)
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    tt_mb = args.tt_mb
+    show_stats = args.stats
+    if show_stats:
+        instrument()
+    workers = args.workers
+    search_mode = args.search
+    book_path = args.book
+    if args.engine:
+        engine_mode = True
+        quiet = True
+        engine_loop()
+    elif args.time is None:
+        parser.error('n, player, board and time are required unless --engine is given')
+    else:
+        duration = float(args.time)
+        betsy_solver(args.player, list(args.board), args.n)
 
 
 
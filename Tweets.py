@@ -15,89 +15,589 @@
 # from certain locations tended to be longer and contain more words, raising the probability of that location given
 # the words in the tweet. 
 
+import io
 import re
+import os
 import sys
+import json
+import time
+import mmap
+import hashlib
 import numpy
+import signal
 import string
+import struct
+import argparse
+import socketserver
+import multiprocessing
+from collections import Counter, deque
 
-train = sys.argv[1]
-test = sys.argv[2]
-output = sys.argv[3]
+parser = argparse.ArgumentParser(description='Guess the location of tweets with a naive Bayes classifier.')
+commands = parser.add_subparsers(dest='command')
+train_parser = commands.add_parser('train', help='train on a file of tweets and write a model file')
+train_parser.add_argument('train')
+train_parser.add_argument('model')
+train_parser.add_argument('--workers', type=int, default=1, help='processes counting the training file')
+train_parser.add_argument('--counts', help='also write the raw counts here, for later updates')
+update_parser = commands.add_parser('update', help='add new labelled tweets to a counts file and its model')
+update_parser.add_argument('counts')
+update_parser.add_argument('train')
+update_parser.add_argument('model', help='the model made from the counts file, updated in place')
+update_parser.add_argument('--workers', type=int, default=1, help='processes counting the new tweets')
+classify_parser = commands.add_parser('classify', help='classify a file of tweets with a model file')
+classify_parser.add_argument('model')
+classify_parser.add_argument('test')
+classify_parser.add_argument('output')
+serve_parser = commands.add_parser('serve', help='classify tweets as they arrive, one per line')
+serve_parser.add_argument('model')
+serve_parser.add_argument('--socket', help='listen on this Unix socket instead of reading stdin')
 
 l = re.compile(r'_[A-Z]')
 
-tweets = []
-locations = []
-unique_locations = []
-loc_words = {}
-with open(train, 'r') as f:
-    for line in f:
-        tweets.append(line)
+# The tweet files are not valid UTF-8, so they are read as latin-1 (one character per byte) and split on
+# '\n' only, the way Python 2 read them. Python 2's lower() on those bytes only changed A-Z, so these
+# tables lowercase ASCII only (and clean also strips punctuation), which keeps the old counts exactly.
+lower = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+clean = str.maketrans(string.ascii_uppercase, string.ascii_lowercase, string.punctuation)
 
-for tweet in tweets:
-    array = tweet.split(' ')
-    locations.append(array[0])
-    if array[0] not in unique_locations:
-        unique_locations.append(array[0])
-        loc_words[array[0]] = []
-    for i in range(1,len(array)):
-        word = array[i].translate(None, string.punctuation).lower()
-        loc_words[array[0]].append(word)
 
+# The tokenizer shared by training and classification: the words of a tweet, lowercased and stripped of
+# punctuation in one translate over the whole text rather than word by word, split on single spaces.
+def tokens(text):
+    return text.translate(clean).split(' ')
 
-loc_prob= {}
-word_loc = {}
 
+# The ids of the words that are in the model's vocabulary, in tweet order. Classification works on these
+# ids only, and words the model does not know are dropped here.
+def token_ids(vocabulary, words):
+    return [vocabulary[word] for word in words if word in vocabulary]
 
-# Probabilities of a given location P(l)
-total_loc = len(locations)
-for location in unique_locations:
-    count = locations.count(location)
-    loc_prob[location] = float(count)/total_loc
 
+# Training is a single pass over the file counting tweets per location and each word per location, so
+# it runs in time linear in the size of the corpus and never holds the tweets in memory. With several
+# workers the file is cut into byte ranges, each moved on to the start of a line, and every range is
+# counted in its own process. A line belongs to the range it starts in. The partial counts are merged in
+# file order, so locations and words keep the order they were first seen in and the model comes out the
+# same as a single process would make it.
+def count_shard(shard):
+    train, start, end = shard
+    unique_locations = []
+    loc_count = Counter()
+    word_count = {}
+    with open(train, 'rb') as f:
+        f.seek(start)
+        position = start
+        for raw in f:
+            if position >= end:
+                break
+            position += len(raw)
+            array = raw.decode('latin-1').split(' ', 1)
+            if array[0] not in word_count:
+                unique_locations.append(array[0])
+                word_count[array[0]] = Counter()
+            loc_count[array[0]] += 1
+            if len(array) > 1:
+                word_count[array[0]].update(tokens(array[1]))
+    return unique_locations, loc_count, word_count
 
-#Probabilities of word given location P(w|l)
-for k in range(0, len(unique_locations)):
-    word_loc[unique_locations[k]] = {}
-    uniq_loc_words = set(loc_words[unique_locations[k]])
-    for word in uniq_loc_words:
-        if loc_words[unique_locations[k]].count(word) > 15:
-            word_loc[unique_locations[k]][word] = float(loc_words[unique_locations[k]].count(word))/len(loc_words[unique_locations[k]])
 
+def shards(train, workers):
+    size = os.path.getsize(train)
+    starts = [0]
+    with open(train, 'rb') as f:
+        for i in range(1, workers):
+            f.seek(max(starts[-1], size * i // workers))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            starts.append(f.tell())
+    starts.append(size)
+    return [(train, starts[i], starts[i + 1]) for i in range(0, workers)]
 
-def bayes_solver(location, words):
-    p_location = loc_prob[location]
-    p_words_loc = []
-    for word in words:
-        word1 = word.translate(None, string.punctuation)
-        if word1 in word_loc[location]:
-            p_words_loc.append(word_loc[location][word1])
-    p_location *=numpy.prod(p_words_loc)
-    return float(p_location)*(10**60)
 
+def count_words(train, workers=1):
+    if workers <= 1:
+        return count_shard((train, 0, os.path.getsize(train)))
+    pool = multiprocessing.Pool(workers)
+    parts = pool.map(count_shard, shards(train, workers))
+    pool.close()
+    unique_locations = []
+    loc_count = Counter()
+    word_count = {}
+    for locations, counts, words in parts:
+        for location in locations:
+            if location not in word_count:
+                unique_locations.append(location)
+                word_count[location] = Counter()
+            word_count[location].update(words[location])
+        loc_count.update(counts)
+    return unique_locations, loc_count, word_count
 
-with open(test, 'r') as f2:
-    with open(output, 'a') as f3:
-        for line in f2:
-            array = line.split(' ')
-            for i in range(1,len(array)):
-                array[i] = array[i].lower()
-            tweet = " ".join(array[1:])
-            max = 0
-            answer = ''
-            for location in unique_locations:
-                a = bayes_solver(location, array[1:])
-                if a > max:
-                    max = a
-                    answer = location
-            f3.write(answer+" "+array[0]+" "+tweet)
 
+# Raw counts, kept so that new labelled tweets can be added to a model without counting the old ones
+# again. A counts segment is the tuple (locations, tweets, totals, keys, pair_counts) made from what
+# count_words() found in some files: every location in the order it was first seen, with its tweet count
+# and token total, and the count of every (word, location) pair seen, sorted by key. A pair's key is a
+# 128 bit hash of the location and the word, so looking pairs up is a numpy.searchsorted() over the keys
+# whatever the words are, and two segments merge with a sort of their keys. A segment made from a file
+# in this run also carries pair_words and pair_locations (the word and the location index of every
+# pair), which update_model() needs and the counts file does not keep.
+def pair_key(location, word):
+    return hashlib.blake2b((location + ' ' + word).encode('latin-1'), digest_size=16).digest()
 
 
+def counts_segment(unique_locations, loc_count, word_count):
+    keys = []
+    pair_counts = []
+    pair_words = []
+    pair_locations = []
+    for k in range(0, len(unique_locations)):
+        location = unique_locations[k]
+        for word, count in word_count[location].items():
+            keys.append(pair_key(location, word))
+            pair_counts.append(count)
+            pair_words.append(word)
+            pair_locations.append(k)
+    keys = numpy.array(keys, dtype='S16')
+    order = numpy.argsort(keys, kind='stable')
+    tweets = numpy.array([loc_count[location] for location in unique_locations], dtype=int)
+    totals = numpy.array([sum(word_count[location].values()) for location in unique_locations], dtype=int)
+    return list(unique_locations), tweets, totals, keys[order], numpy.array(pair_counts, dtype=int)[order], \
+        [pair_words[i] for i in order.tolist()], numpy.array(pair_locations, dtype=int)[order]
 
 
+# Sums two segments. Both keep their own location order, the older one's first.
+def merge_segments(older, newer):
+    locations = list(older[0])
+    tweets = numpy.array(older[1], dtype=int)
+    totals = numpy.array(older[2], dtype=int)
+    location_ids = dict(zip(locations, range(0, len(locations))))
+    for location in newer[0]:
+        if location not in location_ids:
+            location_ids[location] = len(locations)
+            locations.append(location)
+    grow = numpy.zeros(len(locations) - len(tweets), dtype=int)
+    tweets = numpy.concatenate([tweets, grow])
+    totals = numpy.concatenate([totals, grow])
+    ids = numpy.array([location_ids[location] for location in newer[0]], dtype=int)
+    tweets[ids] += newer[1]
+    totals[ids] += newer[2]
+    keys = numpy.concatenate([older[3], newer[3]])
+    pair_counts = numpy.concatenate([numpy.asarray(older[4], dtype=int), numpy.asarray(newer[4], dtype=int)])
+    order = numpy.argsort(keys, kind='stable')
+    keys = keys[order]
+    first = numpy.flatnonzero(numpy.concatenate([[True], keys[1:] != keys[:-1]]))
+    return locations, tweets, totals, keys[first], numpy.add.reduceat(pair_counts[order], first)
 
 
+# How many times each pair of a new segment had been counted already, over all loaded segments.
+def previous_counts(segments, segment):
+    keys = segment[3]
+    before = numpy.zeros(len(keys), dtype=int)
+    for start, old in segments:
+        if len(old[3]) == 0:
+            continue
+        at = numpy.minimum(numpy.searchsorted(old[3], keys), len(old[3]) - 1)
+        found = old[3][at] == keys
+        before[found] += old[4][at[found]].astype(int)
+    return before
 
 
+# Counts file: the magic string, then segments one after the other, each a header holding the number of
+# locations, of pairs and the size of its string table, then these little endian arrays:
+#     tweets and token totals (uint64 per location), pair keys (16 bytes per pair), pair counts (uint64 per
+#     pair), string end offsets (uint64 per location)
+# and last the location names (latin-1), padded to 8 bytes. Training writes one segment. An update adds
+# its own segment at the end, and while the last segment has at least 1/MERGE_RATIO as many pairs as
+# the one before it the two are merged into one, so segments shrink geometrically from the first,
+# there are only a logarithmic number of them to look pairs up in, and each pair is rewritten a
+# logarithmic number of times over all updates. Only the segments merged are rewritten, from the
+# first of them to the end of the file. That new tail is first written in full to <counts file>.tail
+# (renamed into place once complete) and only then copied over the old one, and a .tail file that is
+# found by load_counts() is copied over again, so an update that dies halfway loses nothing.
+COUNTS_MAGIC = b'TWEETCT3'
+SEGMENT_HEADER = struct.Struct('<QQQ')
+TAIL_HEADER = struct.Struct('<Q')
+MERGE_RATIO = 4
 
+
+def write_segment(f, segment):
+    locations, tweets, totals, keys, pair_counts = segment[:5]
+    strings = [name.encode('latin-1') for name in locations]
+    ends = numpy.cumsum([len(name) for name in strings], dtype='<u8')
+    table = b''.join(strings)
+    f.write(SEGMENT_HEADER.pack(len(locations), len(keys), len(table)))
+    for array in tweets, totals:
+        f.write(numpy.asarray(array, dtype='<u8').tobytes())
+    f.write(numpy.asarray(keys, dtype='S16').tobytes())
+    f.write(numpy.asarray(pair_counts, dtype='<u8').tobytes())
+    f.write(ends.tobytes())
+    f.write(table + b'\0' * (-len(table) % 8))
+
+
+def save_counts(path, segment):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(COUNTS_MAGIC)
+        write_segment(f, segment)
+    os.replace(path + '.tmp', path)
+
+
+# Writes the tail that replaces everything in the counts file from offset start on.
+def save_tail(path, start, segments):
+    with open(path + '.tail.tmp', 'wb') as f:
+        f.write(TAIL_HEADER.pack(start))
+        for segment in segments:
+            write_segment(f, segment)
+    os.replace(path + '.tail.tmp', path + '.tail')
+    apply_tail(path)
+
+
+def apply_tail(path):
+    with open(path + '.tail', 'rb') as tail:
+        start, = TAIL_HEADER.unpack(tail.read(TAIL_HEADER.size))
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            f.truncate()
+            while True:
+                block = tail.read(1 << 20)
+                if not block:
+                    break
+                f.write(block)
+    os.remove(path + '.tail')
+
+
+# Adds a new segment to the end of the counts file, merging it with the segments before it as long as
+# it is not much smaller than they are.
+def add_segment(path, segments, end, segment):
+    segments = list(segments)
+    start = end
+    while segments and MERGE_RATIO * len(segment[3]) >= len(segments[-1][1][3]):
+        start, older = segments.pop()
+        segment = merge_segments(older, segment)
+    save_tail(path, start, [segment])
+
+
+# Maps a counts file and returns its segments, each with the offset it starts at, and the offset its
+# last one ends at. The arrays of a loaded segment are views of the map.
+def load_counts(path):
+    if os.path.exists(path + '.tail'):
+        apply_tail(path)
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(COUNTS_MAGIC)] != COUNTS_MAGIC:
+        sys.exit(path + ' is not a counts file')
+    segments = []
+    offset = len(COUNTS_MAGIC)
+    while offset < len(data):
+        start = offset
+        location_count, pair_count, table_size = SEGMENT_HEADER.unpack_from(data, offset)
+        offset += SEGMENT_HEADER.size
+        tweets = numpy.frombuffer(data, dtype='<u8', count=location_count, offset=offset)
+        offset += 8 * location_count
+        totals = numpy.frombuffer(data, dtype='<u8', count=location_count, offset=offset)
+        offset += 8 * location_count
+        keys = numpy.frombuffer(data, dtype='S16', count=pair_count, offset=offset)
+        offset += 16 * pair_count
+        pair_counts = numpy.frombuffer(data, dtype='<u8', count=pair_count, offset=offset)
+        offset += 8 * pair_count
+        ends = numpy.frombuffer(data, dtype='<u8', count=location_count, offset=offset).tolist()
+        offset += 8 * location_count
+        locations = []
+        begin = 0
+        for end in ends:
+            locations.append(data[offset + begin:offset + end].decode('latin-1'))
+            begin = end
+        offset += table_size + -table_size % 8
+        segments.append((start, (locations, tweets, totals, keys, pair_counts)))
+    return segments, offset
+
+
+# Classification works in log space. P(l) is a location's share of the tweets and P(w|l) a word's share
+# of the location's tokens, for words seen more than 15 times there. Every word kept somewhere gets an
+# id, and an inverted index maps it to its postings: the locations that kept it, with the log of the
+# word's count there. log P(w|l) is that minus the log of the location's token total, taken at scoring
+# time, so new tokens in a location change its total and none of its postings. Words a location did not
+# keep were always skipped, so a tweet's score for location l is log P(l) plus the sum of its log P(w|l)
+# for l, and scoring a tweet only walks the postings of its own words, however many locations there
+# are. The first location with the highest score wins, as before. Sums of logs cannot underflow the way
+# the product of probabilities did.
+#
+# A model is the tuple (locations, vocabulary, tweets, totals, log_loc_prob, log_totals, postings).
+# vocabulary maps a word to its id, and postings is (starts, posting_locations, posting_logs): the
+# postings of word i are entries starts[i] to starts[i + 1] of the other two arrays, in location order.
+def empty_model():
+    return [], {}, numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0), numpy.zeros(0), \
+        (numpy.zeros(1, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0))
+
+
+# Adds a counts segment to a model, given how many times each of its pairs had been counted before. Only
+# the segment's own pairs are looked at: its locations' tweets and totals grow, and its pairs now above
+# the threshold get postings with their new log count, replacing the postings they had. Training is
+# adding a whole file to the empty model.
+def update_model(model, segment, before):
+    locations, vocabulary, tweets, totals, log_loc_prob, log_totals, postings = model
+    starts, posting_locations, posting_logs = postings
+    new_locations, new_tweets, new_totals, pair_keys, pair_counts, pair_words, pair_locations = segment
+    locations = list(locations)
+    location_ids = dict(zip(locations, range(0, len(locations))))
+    for location in new_locations:
+        if location not in location_ids:
+            location_ids[location] = len(locations)
+            locations.append(location)
+    ids = numpy.array([location_ids[location] for location in new_locations], dtype=int)
+    grow = numpy.zeros(len(locations) - len(tweets), dtype=int)
+    tweets = numpy.concatenate([tweets, grow])
+    totals = numpy.concatenate([totals, grow])
+    tweets[ids] += new_tweets
+    totals[ids] += new_totals
+    after = before + pair_counts
+    kept = numpy.flatnonzero(after > 15)
+    vocabulary = dict(vocabulary)
+    word_ids = numpy.array([vocabulary.setdefault(pair_words[i], len(vocabulary)) for i in kept.tolist()],
+                           dtype=int)
+    new_keys = word_ids * len(locations) + ids[pair_locations[kept]]
+    old_keys = numpy.repeat(numpy.arange(0, len(starts) - 1), numpy.diff(starts)) * len(locations) + \
+        posting_locations
+    stay = ~numpy.isin(old_keys, new_keys)
+    keys = numpy.concatenate([old_keys[stay], new_keys])
+    logs = numpy.concatenate([posting_logs[stay], numpy.log(after[kept])])
+    order = numpy.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = numpy.searchsorted(keys // max(1, len(locations)), numpy.arange(0, len(vocabulary) + 1))
+    postings = (starts, keys % max(1, len(locations)), logs[order])
+    return locations, vocabulary, tweets, totals, numpy.log(tweets / tweets.sum()), \
+        numpy.log(numpy.maximum(totals, 1)), postings
+
+
+def train_model(segment):
+    return update_model(empty_model(), segment, numpy.zeros(len(segment[4]), dtype=int))
+
+
+# Model file: a header holding the magic string, the number of locations, of words and of postings and
+# the size of the string table, then these little endian arrays:
+#     tweets and token totals (uint64 per location), posting log counts (double per posting),
+#     posting starts (uint64 per word, plus one), string end offsets (uint64 per location and word),
+#     posting locations (uint32 per posting)
+# and last the strings themselves (locations first, then the words in id order, latin-1). The arrays
+# are used straight from a memory map, so loading a model costs one pass over the strings however many
+# postings it has, and processes classifying with the same model share its pages. A model file is
+# replaced whole (written beside it and renamed), so processes that have the old one mapped keep reading it.
+MODEL_MAGIC = b'TWEETMD3'
+MODEL_HEADER = struct.Struct('<8sIIQQ')
+
+
+def save_model(path, model):
+    locations, vocabulary, tweets, totals, log_loc_prob, log_totals, postings = model
+    starts, posting_locations, posting_logs = postings
+    words = sorted(vocabulary, key=vocabulary.get)
+    strings = [name.encode('latin-1') for name in locations + words]
+    ends = numpy.cumsum([len(name) for name in strings], dtype='<u8')
+    table = b''.join(strings)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MODEL_HEADER.pack(MODEL_MAGIC, len(locations), len(words), len(posting_logs), len(table)))
+        f.write(numpy.asarray(tweets, dtype='<u8').tobytes())
+        f.write(numpy.asarray(totals, dtype='<u8').tobytes())
+        f.write(numpy.asarray(posting_logs, dtype='<f8').tobytes())
+        f.write(numpy.asarray(starts, dtype='<u8').tobytes())
+        f.write(ends.tobytes())
+        f.write(numpy.asarray(posting_locations, dtype='<u4').tobytes())
+        f.write(table)
+    os.replace(path + '.tmp', path)
+
+
+def load_model(path):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, location_count, word_count, posting_count, table_size = MODEL_HEADER.unpack_from(data, 0)
+    if magic != MODEL_MAGIC:
+        sys.exit(path + ' is not a model file')
+    offset = MODEL_HEADER.size
+    tweets = numpy.frombuffer(data, dtype='<u8', count=location_count, offset=offset).astype(int)
+    offset += 8 * location_count
+    totals = numpy.frombuffer(data, dtype='<u8', count=location_count, offset=offset).astype(int)
+    offset += 8 * location_count
+    posting_logs = numpy.frombuffer(data, dtype='<f8', count=posting_count, offset=offset)
+    offset += 8 * posting_count
+    starts = numpy.frombuffer(data, dtype='<u8', count=word_count + 1, offset=offset).astype(int)
+    offset += 8 * (word_count + 1)
+    ends = numpy.frombuffer(data, dtype='<u8', count=location_count + word_count, offset=offset).tolist()
+    offset += 8 * (location_count + word_count)
+    posting_locations = numpy.frombuffer(data, dtype='<u4', count=posting_count, offset=offset)
+    offset += 4 * posting_count
+    table = data[offset:offset + table_size].decode('latin-1')
+    strings = []
+    start = 0
+    for end in ends:
+        strings.append(table[start:end])
+        start = end
+    vocabulary = dict((strings[location_count + i], i) for i in range(0, word_count))
+    return strings[:location_count], vocabulary, tweets, totals, numpy.log(tweets / tweets.sum()), \
+        numpy.log(numpy.maximum(totals, 1)), (starts, posting_locations, posting_logs)
+
+
+# Scores tweets from the (tweet, word id) pair of every known word in them: the postings of every word
+# are gathered at once and summed per (tweet, location). Returns a row of scores per tweet.
+def bayes_scores(model, rows, columns, count):
+    locations, vocabulary, tweets, totals, log_loc_prob, log_totals, postings = model
+    starts, posting_locations, posting_logs = postings
+    columns = numpy.array(columns, dtype=int)
+    first = starts[columns]
+    lengths = starts[columns + 1] - first
+    ends = numpy.cumsum(lengths)
+    entries = numpy.arange(ends[-1] if len(ends) else 0) + numpy.repeat(first - ends + lengths, lengths)
+    found = posting_locations[entries]
+    cells = numpy.repeat(numpy.array(rows, dtype=int), lengths) * len(locations) + found
+    weights = posting_logs[entries] - log_totals[found]
+    scores = numpy.bincount(cells, weights=weights, minlength=count * len(locations))
+    return scores.reshape(count, len(locations)) + log_loc_prob
+
+
+BATCH = 1024
+
+
+# Scores of every location for each tweet (a list of words) in a batch.
+def batch_scores(model, batch):
+    rows = []
+    columns = []
+    for i in range(0, len(batch)):
+        ids = token_ids(model[1], batch[i])
+        rows += [i] * len(ids)
+        columns += ids
+    return bayes_scores(model, rows, columns, len(batch))
+
+
+def bayes_batch(model, batch):
+    return batch_scores(model, batch).argmax(axis=1)
+
+
+# Splits a line of a tweet file into its first word (the location label), the rest of the line in lower
+# case as it is written out, and the cleaned words that are scored.
+def split_tweet(line):
+    array = line.split(' ', 1)
+    if len(array) > 1:
+        return array[0], array[1].translate(lower), tokens(array[1])
+    return array[0], '', []
+
+
+def write_batch(model, f3, lines, batch):
+    best = bayes_batch(model, batch)
+    for i in range(0, len(lines)):
+        f3.write(model[0][best[i]]+" "+lines[i][0]+" "+lines[i][1])
+
+
+def classify(model, test, output):
+    with open(test, 'r', encoding='latin-1', newline='\n') as f2:
+        with open(output, 'a', encoding='latin-1', newline='\n') as f3:
+            lines = []
+            batch = []
+            for line in f2:
+                label, tweet, words = split_tweet(line)
+                lines.append((label, tweet))
+                batch.append(words)
+                if len(batch) == BATCH:
+                    write_batch(model, f3, lines, batch)
+                    lines = []
+                    batch = []
+            if batch:
+                write_batch(model, f3, lines, batch)
+
+
+# Scores a single tweet. Returns the best location and its score.
+def bayes_tweet(model, words):
+    columns = token_ids(model[1], words)
+    scores = bayes_scores(model, [0] * len(columns), columns, 1)[0]
+    best = scores.argmax()
+    return model[0][best], scores[best]
+
+
+# Server mode. The model is loaded once, then tweets are read a line at a time, in the format of the test
+# files, from stdin or from every connection to a Unix socket. Each answer is written and flushed as soon
+# as its line has been scored, as '<location> <score> <line as classify writes it>', so nothing waits in
+# an output buffer. The time from reading a line to flushing its answer is kept for the last
+# LATENCY_WINDOW tweets, and p50/p99 latencies are reported on stderr when the input ends or the server
+# is stopped with SIGINT or SIGTERM.
+LATENCY_WINDOW = 100000
+latencies = deque(maxlen=LATENCY_WINDOW)
+
+
+def serve_stream(model, f2, f3):
+    while True:
+        line = f2.readline()
+        if not line:
+            break
+        started = time.perf_counter()
+        label, tweet, words = split_tweet(line)
+        location, score = bayes_tweet(model, words)
+        f3.write('%s %.4f %s %s' % (location, score, label, tweet))
+        f3.flush()
+        latencies.append(time.perf_counter() - started)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def latency_report(started):
+    elapsed = time.time() - started
+    report = {'tweets': len(latencies)}
+    if latencies:
+        report['p50_ms'] = round(percentile(latencies, 0.5) * 1000, 3)
+        report['p99_ms'] = round(percentile(latencies, 0.99) * 1000, 3)
+    report['seconds'] = round(elapsed, 3)
+    sys.stderr.write(json.dumps(report) + '\n')
+
+
+def serve(model, path):
+    started = time.time()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if path is None:
+            serve_stream(model, io.TextIOWrapper(sys.stdin.buffer, encoding='latin-1', newline='\n'),
+                         io.TextIOWrapper(sys.stdout.buffer, encoding='latin-1', newline='\n'))
+        else:
+            class Handler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    serve_stream(model, io.TextIOWrapper(self.rfile, encoding='latin-1', newline='\n'),
+                                 io.TextIOWrapper(self.wfile, encoding='latin-1', newline='\n'))
+            if os.path.exists(path):
+                os.remove(path)
+            server = socketserver.ThreadingUnixStreamServer(path, Handler)
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+                os.remove(path)
+    except KeyboardInterrupt:
+        pass
+    latency_report(started)
+
+
+# Command line:
+#     python Tweets.py train <training file> <model file> [--counts <counts file>]
+#     python Tweets.py update <counts file> <new training file> <model file>
+#     python Tweets.py classify <model file> <test file> <output file>
+#     python Tweets.py serve <model file> [--socket <path>]
+#     python Tweets.py <training file> <test file> <output file>    (trains and classifies in one run)
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] not in ['train', 'update', 'classify', 'serve']:
+        classify(train_model(counts_segment(*count_words(sys.argv[1]))), sys.argv[2], sys.argv[3])
+    else:
+        args = parser.parse_args()
+        if args.command == 'train':
+            segment = counts_segment(*count_words(args.train, args.workers))
+            if args.counts is not None:
+                save_counts(args.counts, segment)
+            save_model(args.model, train_model(segment))
+        elif args.command == 'update':
+            segments, end = load_counts(args.counts)
+            segment = counts_segment(*count_words(args.train, args.workers))
+            model = update_model(load_model(args.model), segment, previous_counts(segments, segment))
+            add_segment(args.counts, segments, end, segment)
+            save_model(args.model, model)
+        elif args.command == 'classify':
+            classify(load_model(args.model), args.test, args.output)
+        elif args.command == 'serve':
+            serve(load_model(args.model), args.socket)
+        else:
+            parser.print_help()
@@ -0,0 +1,115 @@
+#!/bin/python
+
+# Builds the opening book and endgame table read by Betsy.py. Openings are every position reachable from
+# the empty board within a few plies (with either colour moving first), endgames are random positions
+# with only a few empty cells left. Each position is searched with Betsy's own search and the chosen
+# move is written to a sorted binary file that Betsy.py memory maps and binary searches at run time.
+#
+#     python betsy_book.py betsy.book --openings 3:4 4:2 5:1 --endgames 3:200 --time 1
+
+import sys
+import time
+import random
+import argparse
+import Betsy
+
+parser = argparse.ArgumentParser(description='Build the Betsy opening book and endgame table.')
+parser.add_argument('output')
+parser.add_argument('--openings', nargs='*', default=['3:4', '4:2', '5:1'],
+                    help='n:plies pairs, every position up to that many plies from the empty board is searched')
+parser.add_argument('--endgames', nargs='*', default=['3:200'],
+                    help='n:count pairs, that many random positions with few empty cells are searched')
+parser.add_argument('--empty', type=int, default=3, help='most empty cells in an endgame position')
+parser.add_argument('--depth', type=int, default=12, help='deepest search per position')
+parser.add_argument('--time', type=float, default=1.0, help='search time per position, in seconds')
+parser.add_argument('--seed', type=int, default=0)
+
+
+def other(player):
+    return Betsy.PLAYERS[1 - Betsy.PLAYERS.index(player)]
+
+
+# Breadth first walk from the empty board, alternating players, keeping each (position, player to move)
+# once, a position and its mirror image counting as the same.
+def openings(n, plies):
+    positions = []
+    seen = set()
+    for first in Betsy.PLAYERS:
+        layer = [(Betsy.board_to_bits(['.'] * (n * (n + 3)), n), first)]
+        for ply in range(0, plies + 1):
+            following = []
+            for pos, player in layer:
+                key = min(Betsy.root_keys(pos, player, n))
+                if key in seen:
+                    continue
+                seen.add(key)
+                positions.append((pos, player))
+                for successor in Betsy.bit_successors(Betsy.PLAYERS.index(player), pos, n):
+                    following.append((successor[2], other(player)))
+            layer = following
+    return positions
+
+
+# Positions from random legal games. From the empty board, with either player starting, the players
+# take turns at a random drop or rotation (a drop only while they have pebbles left, n(n+3)/2 each) until
+# at most `empty` cells are empty. A game in which somebody completes a line first is thrown away, so
+# every position kept can come up in play, with the right player to move.
+def endgames(n, count, empty, rng):
+    positions = []
+    pebbles = n * (n + 3) // 2
+    while len(positions) < count:
+        pos = Betsy.board_to_bits(['.'] * (n * (n + 3)), n)
+        player = rng.choice(Betsy.PLAYERS)
+        target = rng.randint(0, empty)
+        while n * (n + 3) - sum(pos[2]) > target:
+            p = Betsy.PLAYERS.index(player)
+            moves = [successor for successor in Betsy.bit_successors(p, pos, n)
+                     if successor[0] == 'rotate' or bin(pos[p]).count('1') < pebbles]
+            pos = rng.choice(moves)[2]
+            player = other(player)
+            if Betsy.bit_win(pos[0], n) or Betsy.bit_win(pos[1], n):
+                break
+        else:
+            positions.append((pos, player))
+    return positions
+
+
+def build(args):
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    Betsy.quiet = True
+    Betsy.book_path = None
+    Betsy.MAX_DEPTH = args.depth
+    Betsy.duration = args.time / Betsy.TIME_SAFETY
+    positions = []
+    for spec in args.openings:
+        n, plies = [int(x) for x in spec.split(':')]
+        positions += [(n, pos, player) for pos, player in openings(n, plies)]
+    for spec in args.endgames:
+        n, count = [int(x) for x in spec.split(':')]
+        positions += [(n, pos, player) for pos, player in endgames(n, count, args.empty, rng)]
+    records = {}
+    for i in range(0, len(positions)):
+        n, pos, player = positions[i]
+        key, mirror = Betsy.root_keys(pos, player, n)
+        if (min(key, mirror), n) in records:
+            continue
+        Betsy.start_time = time.time()
+        score = Betsy.betsy_solver(player, Betsy.bits_to_board(pos, n), n)
+        if score is None or Betsy.recommend == '':
+            continue
+        move = Betsy.recommend
+        if mirror < key:
+            move = Betsy.mirror_move(move, n)
+        records[(min(key, mirror), n)] = (int(score), Betsy.BOOK_MOVES.index(move[:-1]), int(move[-1:]),
+                                          Betsy.last_depth)
+        sys.stderr.write('%d/%d positions\r' % (i + 1, len(positions)))
+    with open(args.output, 'wb') as f:
+        f.write(Betsy.BOOK_HEADER.pack(Betsy.BOOK_MAGIC, len(records)))
+        for key, n in sorted(records):
+            f.write(Betsy.BOOK_RECORD.pack(key, *(records[(key, n)] + (n,))))
+    sys.stderr.write('\nwrote %d positions to %s\n' % (len(records), args.output))
+
+
+if __name__ == '__main__':
+    build(parser.parse_args())
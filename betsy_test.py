@@ -183,12 +183,10 @@ def max_value(player, board, alpha, beta, n, path):
             if len(path) > 1:
                 recommend = path[1]
                 answer(player, board, n)
-            print('max', a)
             return a
         alpha = max(alpha, a)
     if len(path) > 1:
         recommend = path[1]
-    print('max',a)
     return a
 
 # Calculates the best move for the other player ('min'). The best move for 'min' is the one that generates the lowest
@@ -229,12 +227,10 @@ def min_value(player, board, alpha, beta, n, path):
         if a <= alpha:
             if len(path) > 1:
                 recommend = path[1]
-            print('min', a)
             return a
         beta = min(beta, a)
     if len(path) > 1:
         recommend = path[1]
-    print('min',a)
     return a
 
 # Begins the call of max_value to find solution
@@ -0,0 +1,278 @@
+#!/bin/python
+
+# Self-play tournaments between Betsy engines, and micro-benchmarks of the move generator and evaluator.
+#
+# An engine is any script that takes the usual 'n player board time' arguments and prints lines such as
+# "I'd recommend dropping a pebble in column  3 .  <board>", the last of which is its move. Engines are
+# given as name=script [options] and run as separate processes, one per move, so Betsy.py and
+# betsy_test.py can be played against each other as they are. Every pair of engines plays every start
+# position twice, once with each colour. A move counts if it was printed before the time limit plus
+# --grace ran out (the process is killed then), and an engine that prints no legal move loses. Engines
+# run with unbuffered output, so nothing they printed is lost when they are killed. Engines that print a
+# --stats report on stderr also get nodes per second and search depth in the results.
+#
+#     python betsy_tournament.py play --engine betsy=Betsy.py 'mcts=Betsy.py --search mcts' --n 4 5 --time 1
+#     python betsy_tournament.py bench --n 3 4 5
+
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import argparse
+import subprocess
+import multiprocessing
+import Betsy
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description='Play Betsy engines against each other, or benchmark the move generator.')
+commands = parser.add_subparsers(dest='command')
+play_parser = commands.add_parser('play', help='play a round robin tournament between engines')
+play_parser.add_argument('--engine', nargs='+', default=['betsy=Betsy.py --stats', 'test=betsy_test.py'],
+                         help='name=script [options] for each engine, run from this directory')
+play_parser.add_argument('--n', type=int, nargs='+', default=[3, 4], help='board sizes to play')
+play_parser.add_argument('--random', type=int, default=4, help='random start positions per board size')
+play_parser.add_argument('--plies', type=int, default=6, help='most random drops in a random start position')
+play_parser.add_argument('--time', type=float, default=1.0, help='time limit per move, in seconds')
+play_parser.add_argument('--grace', type=float, default=0.5,
+                         help='seconds past the time limit before an engine is stopped')
+play_parser.add_argument('--max-plies', type=int, default=100, help='a game this long is a draw')
+play_parser.add_argument('--workers', type=int, default=2, help='games played at the same time')
+play_parser.add_argument('--seed', type=int, default=0)
+bench_parser = commands.add_parser('bench', help='time drop, rotate, successors, value and win_test')
+bench_parser.add_argument('--n', type=int, nargs='+', default=[3, 4, 5], help='board sizes to benchmark')
+bench_parser.add_argument('--calls', type=int, default=2000, help='calls per function, position and run')
+bench_parser.add_argument('--seed', type=int, default=0)
+
+# Start positions every tournament plays, on top of the empty boards and the random ones.
+FIXED = [
+    (3, '.........bbwbwwbwb', 'w'),
+    (4, '....................w..bbw.w', 'w'),
+]
+
+
+def other(player):
+    return Betsy.PLAYERS[1 - Betsy.PLAYERS.index(player)]
+
+
+# A position reached by a few random drops from the empty board, in which nobody has a line yet.
+def random_position(n, plies, rng):
+    while True:
+        pos = Betsy.board_to_bits(['.'] * (n * (n + 3)), n)
+        player = 'w'
+        for ply in range(0, rng.randint(1, plies)):
+            column = rng.randint(1, n)
+            pos = Betsy.bit_drop(Betsy.PLAYERS.index(player), column, pos, n) or pos
+            player = other(player)
+        if not Betsy.bit_win(pos[0], n) and not Betsy.bit_win(pos[1], n):
+            return ''.join(Betsy.bits_to_board(pos, n)), player
+
+
+def start_positions(args, rng):
+    positions = []
+    for n in args.n:
+        positions.append((n, '.' * (n * (n + 3)), 'w'))
+        positions += [fixed for fixed in FIXED if fixed[0] == n]
+        for i in range(0, args.random):
+            positions.append((n,) + random_position(n, args.plies, rng))
+    return positions
+
+
+# The move an engine printed last, applied to the board, or None if it printed no legal move. The move is
+# read from the words of the line rather than from the board printed after it, since betsy_test.py
+# prints the recommendation against whatever board its search had reached.
+def read_move(output, player, board, n):
+    for line in reversed(output.splitlines()):
+        words = line.split()
+        if line.startswith("I'd recommend") and 'column' in words:
+            column = words[words.index('column') + 1:][:1]
+            if not column or not column[0].isdigit() or not 1 <= int(column[0]) <= n:
+                return None
+            column = int(column[0])
+            pos = Betsy.board_to_bits(board, n)
+            if words[2] == 'dropping':
+                pos = Betsy.bit_drop(Betsy.PLAYERS.index(player), column, pos, n)
+                if pos is None:
+                    return None
+            else:
+                pos = Betsy.bit_rotate(column, pos, n)
+            return ''.join(Betsy.bits_to_board(pos, n))
+    return None
+
+
+# The --stats report an engine printed on stderr, if any.
+def read_stats(errors):
+    for line in reversed(errors.splitlines()):
+        if line.startswith('{'):
+            try:
+                return json.loads(line)
+            except ValueError:
+                return None
+    return None
+
+
+# Plays one game and returns who won (an engine name, or None for a draw), how, and every move's engine,
+# time and stats. The player who has just moved wins if they have a line, otherwise their opponent does
+# if they have one.
+def play_game(task):
+    n, board, player, engines, args = task
+    moves = []
+    winner = None
+    reason = 'draw'
+    for ply in range(0, args.max_plies):
+        name, command = engines[player]
+        started = time.time()
+        process = subprocess.Popen([sys.executable, '-u'] + command + [str(n), player, board, str(args.time)],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   universal_newlines=True, cwd=HERE)
+        try:
+            output, errors = process.communicate(timeout=args.time + args.grace)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            output, errors = process.communicate()
+        moves.append((name, time.time() - started, read_stats(errors)))
+        after = read_move(output, player, board, n)
+        if after is None:
+            winner = engines[other(player)][0]
+            reason = 'forfeit'
+            break
+        board = after
+        pos = Betsy.board_to_bits(board, n)
+        mover = Betsy.PLAYERS.index(player)
+        if Betsy.bit_win(pos[mover], n):
+            winner = name
+            reason = 'line'
+            break
+        if Betsy.bit_win(pos[1 - mover], n):
+            winner = engines[other(player)][0]
+            reason = 'line'
+            break
+        player = other(player)
+    return (engines['w'][0], engines['b'][0], n, winner, reason, moves)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 4)
+
+
+def report(games, names):
+    engines = {}
+    for name in names:
+        engines[name] = {'games': 0, 'wins': 0, 'losses': 0, 'draws': 0, 'forfeits': 0, 'moves': [], 'stats': []}
+    pairs = {}
+    for white, black, n, winner, reason, moves in games:
+        pair = pairs.setdefault(' vs '.join(sorted([white, black])), {white: 0, black: 0, 'draws': 0})
+        for name in white, black:
+            engines[name]['games'] += 1
+            if winner is None:
+                engines[name]['draws'] += 1
+            elif winner == name:
+                engines[name]['wins'] += 1
+            else:
+                engines[name]['losses'] += 1
+                if reason == 'forfeit':
+                    engines[name]['forfeits'] += 1
+        if winner is None:
+            pair['draws'] += 1
+        else:
+            pair[winner] += 1
+        for name, seconds, stats in moves:
+            engines[name]['moves'].append(seconds)
+            if stats is not None:
+                engines[name]['stats'].append(stats)
+    for name in names:
+        entry = engines[name]
+        moves = entry.pop('moves')
+        stats = entry.pop('stats')
+        entry['win_rate'] = round((entry['wins'] + 0.5 * entry['draws']) / entry['games'], 4) if entry['games'] else None
+        entry['moves'] = len(moves)
+        entry['move_seconds'] = {'p50': percentile(moves, 0.5), 'p90': percentile(moves, 0.9),
+                                 'p99': percentile(moves, 0.99), 'max': percentile(moves, 1.0)}
+        searched = [s for s in stats if not s.get('book')]
+        seconds = sum(s['seconds'] for s in searched)
+        entry['book_moves'] = len(stats) - len(searched)
+        entry['nodes_per_second'] = int(sum(s['nodes'] + s['leaves'] for s in searched) / seconds) if seconds else None
+        entry['playouts_per_second'] = int(sum(s.get('playouts', 0) for s in searched) / seconds) if seconds else None
+        entry['average_depth'] = round(float(sum(s['depth'] for s in searched)) / len(searched), 2) if searched else None
+    return {'games': len(games), 'engines': engines, 'pairs': pairs}
+
+
+def play(args):
+    rng = random.Random(args.seed)
+    engines = []
+    for spec in args.engine:
+        name, command = spec.split('=', 1)
+        engines.append((name, shlex.split(command)))
+    tasks = []
+    for n, board, player in start_positions(args, rng):
+        for i in range(0, len(engines)):
+            for j in range(0, len(engines)):
+                if i != j:
+                    tasks.append((n, board, player, {player: engines[i], other(player): engines[j]}, args))
+    games = []
+    pool = multiprocessing.Pool(args.workers)
+    for game in pool.imap_unordered(play_game, tasks):
+        games.append(game)
+        sys.stderr.write('%d/%d games\r' % (len(games), len(tasks)))
+    pool.close()
+    sys.stderr.write('\n')
+    print(json.dumps(report(games, [engine[0] for engine in engines]), indent=2))
+
+
+# Micro-benchmarks on fixed positions: the empty board, a few random drops in and a nearly full board,
+# the same for every run with the same --seed. Each function is timed for both the board (list of
+# characters) version and the bitboard version the search uses, best of three runs.
+def bench_positions(n, rng):
+    boards = ['.' * (n * (n + 3)), random_position(n, n * 2, rng)[0]]
+    pos = Betsy.board_to_bits(['.'] * (n * (n + 3)), n)
+    for i in range(0, n * (n + 3) - n):
+        pos = Betsy.bit_drop(i % 2, rng.randint(1, n), pos, n) or pos
+    boards.append(''.join(Betsy.bits_to_board(pos, n)))
+    return [(list(board), Betsy.board_to_bits(board, n)) for board in boards]
+
+
+BENCH = [
+    ('drop', lambda n, board, pos: Betsy.drop('w', n, board, n), lambda n, board, pos: Betsy.bit_drop(0, n, pos, n)),
+    ('rotate', lambda n, board, pos: Betsy.rotate(1, board, n), lambda n, board, pos: Betsy.bit_rotate(1, pos, n)),
+    ('successors', lambda n, board, pos: Betsy.successors('w', board, n),
+     lambda n, board, pos: Betsy.bit_successors(0, pos, n)),
+    ('value', lambda n, board, pos: Betsy.value('w', board, n), lambda n, board, pos: Betsy.bit_value(0, pos, n)),
+    ('win_test', lambda n, board, pos: Betsy.win_test('w', board, n), lambda n, board, pos: Betsy.bit_win(pos[0], n)),
+]
+
+
+def bench(args):
+    rng = random.Random(args.seed)
+    results = {}
+    for n in args.n:
+        positions = bench_positions(n, rng)
+        for name, on_board, on_bits in BENCH:
+            entry = results.setdefault(name, {})
+            for kind, function in ('board', on_board), ('bits', on_bits):
+                best = None
+                for run in range(0, 3):
+                    started = time.perf_counter()
+                    for board, pos in positions:
+                        for i in range(0, args.calls):
+                            function(n, board, pos)
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                calls = args.calls * len(positions)
+                entry['%s n=%d' % (kind, n)] = {'calls_per_second': int(calls / best),
+                                                 'microseconds': round(best / calls * 1e6, 3)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command == 'play':
+        play(args)
+    elif args.command == 'bench':
+        bench(args)
+    else:
+        parser.print_help()
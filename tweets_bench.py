@@ -0,0 +1,138 @@
+#!/bin/python
+
+# Benchmark and accuracy suite for Tweets.py. For each corpus (tweets.train.txt as it is, or repeated
+# --scale times to stand in for a bigger corpus) it trains a model and classifies the test file, and
+# writes one JSON report:
+#     training: wall time and peak memory of 'Tweets.py train', and the model file size
+#     classification: wall time and peak memory of 'Tweets.py classify' on the whole test file, batch
+#         throughput in tweets per second, and p50/p90/p99 latency of scoring one tweet at a time
+#     quality: accuracy and top-k accuracy against the location each test line starts with, and how
+#         many different locations were predicted at all
+# Training and classify runs are separate processes so their peak memory can be read back on its own;
+# throughput, latency and accuracy are measured in this process with the model file loaded.
+#
+#     python tweets_bench.py --scale 1 10 100 --output bench.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import Tweets
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark training and classification of Tweets.py.')
+parser.add_argument('--train', default=os.path.join(HERE, 'tweets.train.txt'))
+parser.add_argument('--test', default=os.path.join(HERE, 'tweets.test1.txt'))
+parser.add_argument('--scale', type=int, nargs='+', default=[1, 10],
+                    help='run on the training file repeated this many times')
+parser.add_argument('--workers', type=int, default=1, help='processes counting the training file')
+parser.add_argument('--top', type=int, nargs='+', default=[1, 3, 5], help='k for top-k accuracy')
+parser.add_argument('--output', help='write the JSON report here instead of stdout')
+
+
+# Runs a Tweets.py subcommand and returns its wall time and peak resident memory (in megabytes).
+def run(arguments):
+    started = time.time()
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, 'Tweets.py')] + arguments)
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - started
+    if status != 0:
+        sys.exit('Tweets.py ' + ' '.join(arguments) + ' failed')
+    return round(elapsed, 4), round(usage.ru_maxrss / 1024.0, 1)
+
+
+def read_test(test):
+    labels = []
+    batch = []
+    with open(test, 'r', encoding='latin-1', newline='\n') as f:
+        for line in f:
+            label, tweet, words = Tweets.split_tweet(line)
+            labels.append(label)
+            batch.append(words)
+    return labels, batch
+
+
+def measure(model_path, labels, batch, top):
+    model = Tweets.load_model(model_path)
+    started = time.perf_counter()
+    for i in range(0, len(batch), Tweets.BATCH):
+        Tweets.bayes_batch(model, batch[i:i + Tweets.BATCH])
+    batch_seconds = time.perf_counter() - started
+    latencies = []
+    for words in batch:
+        started = time.perf_counter()
+        Tweets.bayes_tweet(model, words)
+        latencies.append(time.perf_counter() - started)
+    ranking = (-Tweets.batch_scores(model, batch)).argsort(axis=1, kind='stable')
+    hits = dict((k, 0) for k in top)
+    predicted = set()
+    for i in range(0, len(batch)):
+        ranked = [model[0][j] for j in ranking[i][:max(top)]]
+        predicted.add(ranked[0])
+        for k in top:
+            if labels[i] in ranked[:k]:
+                hits[k] += 1
+    return {
+        'tweets_per_second': int(len(batch) / batch_seconds) if batch_seconds > 0 else 0,
+        'latency_ms': {'p50': round(Tweets.percentile(latencies, 0.5) * 1000, 4),
+                       'p90': round(Tweets.percentile(latencies, 0.9) * 1000, 4),
+                       'p99': round(Tweets.percentile(latencies, 0.99) * 1000, 4)},
+        'accuracy': round(float(hits[1]) / len(batch), 4) if 1 in hits else None,
+        'top_k_accuracy': dict((str(k), round(float(hits[k]) / len(batch), 4)) for k in top),
+        'distinct_predictions': len(predicted),
+        'locations': len(model[0]),
+        'vocabulary': len(model[1]),
+    }
+
+
+def bench(args):
+    labels, batch = read_test(args.test)
+    results = []
+    directory = tempfile.mkdtemp()
+    for scale in args.scale:
+        corpus = args.train
+        if scale != 1:
+            corpus = os.path.join(directory, 'train.%d.txt' % scale)
+            with open(args.train, 'rb') as f:
+                data = f.read()
+            if not data.endswith(b'\n'):
+                data += b'\n'
+            with open(corpus, 'wb') as f:
+                for i in range(0, scale):
+                    f.write(data)
+        model = os.path.join(directory, 'model.%d' % scale)
+        output = os.path.join(directory, 'output.%d.txt' % scale)
+        train_seconds, train_mb = run(['train', corpus, model, '--workers', str(args.workers)])
+        classify_seconds, classify_mb = run(['classify', model, args.test, output])
+        result = {
+            'scale': scale,
+            'train_lines': sum(1 for line in open(corpus, 'rb')),
+            'train_bytes': os.path.getsize(corpus),
+            'train_seconds': train_seconds,
+            'train_peak_mb': train_mb,
+            'model_bytes': os.path.getsize(model),
+            'test_lines': len(batch),
+            'classify_seconds': classify_seconds,
+            'classify_peak_mb': classify_mb,
+        }
+        result.update(measure(model, labels, batch, args.top))
+        results.append(result)
+        for name in corpus, model, output:
+            if name != args.train:
+                os.remove(name)
+        sys.stderr.write('scale %d done\n' % scale)
+    os.rmdir(directory)
+    report = json.dumps({'train': args.train, 'test': args.test, 'results': results}, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    bench(parser.parse_args())